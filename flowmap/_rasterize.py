@@ -0,0 +1,40 @@
+"""
+Compiled rasterization of grid cells onto the rendering canvas
+"""
+import math
+
+import numba
+
+
+@numba.njit(parallel=True, cache=True)
+def rasterize_quads(xs, ys, out):
+    """burn the polygons with vertices xs, ys (n_polygons, n_vertices), in pixel coordinates, into the boolean array out"""
+    ny, nx = out.shape
+    n_vertices = xs.shape[1]
+    for k in numba.prange(xs.shape[0]):
+        y_min = ys[k, 0]
+        y_max = ys[k, 0]
+        for e in range(1, n_vertices):
+            y_min = min(y_min, ys[k, e])
+            y_max = max(y_max, ys[k, e])
+        # pixel centers are at integer coordinates (same as skimage.draw.polygon)
+        j_lo = max(int(math.ceil(y_min)), 0)
+        j_hi = min(int(math.floor(y_max)), ny - 1)
+        for j in range(j_lo, j_hi + 1):
+            x_left = math.inf
+            x_right = -math.inf
+            # intersect the scanline with all edges
+            for e in range(n_vertices):
+                x0, y0 = xs[k, e], ys[k, e]
+                x1, y1 = xs[k, (e + 1) % n_vertices], ys[k, (e + 1) % n_vertices]
+                if (y0 <= j < y1) or (y1 <= j < y0):
+                    x = x0 + (j - y0) * (x1 - x0) / (y1 - y0)
+                    x_left = min(x_left, x)
+                    x_right = max(x_right, x)
+            if x_left > x_right:
+                continue
+            i_lo = max(int(math.ceil(x_left)), 0)
+            i_hi = min(int(math.floor(x_right)), nx - 1)
+            for i in range(i_lo, i_hi + 1):
+                out[j, i] = True
+    return out
@@ -7,17 +7,14 @@ import pandas
 import geojson
 import tqdm
 import netCDF4
-import scipy.interpolate
 import numpy as np
-import skimage.draw
-import skimage.morphology
-import matplotlib.pyplot as plt
-import matplotlib.colors
+import PIL.Image
 
 # we need a separate transform that keeps masks
-from .formats import transform
+from .formats import transform, nearest_points
 from .netcdf import NetCDF
 from .json_encoder import RegistryEncoder as Encoder
+from .._rasterize import rasterize_quads
 
 logger = logging.getLogger(__name__)
 
@@ -109,30 +106,24 @@ class Delft3DMatlab(NetCDF):
         """generate an animation (set of png's)"""
 
         logger.debug("Generating animation")
-        F, X, Y = self.canvas['F'], self.canvas['X'], self.canvas['Y']
-
-        X_web = self.grid['X_web']
-        Y_web = self.grid['Y_web']
-        coordinate_mask = np.logical_or(X_web.mask, Y_web.mask)
-
         framescale = float(self.framescale)
         count = itertools.count()
 
-        N = matplotlib.colors.Normalize(self.vmin, self.vmax, clip=True)
+        # buffer for the normalized velocities
+        RG = np.empty(self.canvas['is_grid'].shape + (2, ))
+        data = self.variables(0)
+        UV1 = self.to_canvas(data['u1'], data['v1'])
+        # fix the color range on the first frame
+        vmin, scale = self.normalization(UV1)
         for i in tqdm.tqdm(range(self.grid['time'].shape[0] - 1)):
-            # get data for t = t
-            data_0 = self.variables(i)
-            data_1 = self.variables(i+1)
-            u0, v0 = data_0['u1'], data_0['v1']
-            u1, v1 = data_1['u1'], data_1['v1']
+            # regrid once per time step, interpolation in time commutes with the linear regridding
+            # the last time step is the first of the next interval, only read the new one
+            UV0 = UV1
+            data = self.variables(i + 1)
+            UV1 = self.to_canvas(data['u1'], data['v1'])
             for j in tqdm.tqdm(range(int(framescale))):
-                u = (1.0 - (j/framescale)) * u0 + (j/framescale) * u1
-                v = (1.0 - (j/framescale)) * v0 + (j/framescale) * v1
-                # compute uv and mask with coordinate mask
-                uv = np.c_[u[~coordinate_mask], v[~coordinate_mask].ravel()]
-                F.values = uv.astype(F.values.dtype)
-                UV = F(X, Y)
-                RG = N(UV)
+                UV = (1.0 - (j/framescale)) * UV0 + (j/framescale) * UV1
+                self.normalize(UV, vmin, scale, out=RG)
                 R, G = RG[..., 0], RG[..., 1]
 
                 # cells without a velocity
@@ -142,7 +133,9 @@ class Delft3DMatlab(NetCDF):
                 RGB = np.dstack([R, G, B])
                 # store in filename
                 # TODO: generate with ffmpeg
-                plt.imsave('test_%06d.png' % (next(count),), RGB)
+                # fast, low compression png, the frames are converted to a movie afterwards
+                img = PIL.Image.fromarray((RGB * 255).astype('uint8'))
+                img.save('test_%06d.png' % (next(count),), format='PNG', compress_level=1)
         logger.debug("Animation generated")
 
     def variables(self, t):
@@ -193,23 +186,15 @@ class Delft3DMatlab(NetCDF):
         y_px_c = ny * (y_web_c - ll_web[1]) / (ur_web[1] - ll_web[1])
 
         is_grid = np.zeros((ny, nx), dtype='bool')
-        for x_, y_ in zip(x_px_c, y_px_c):
-            rr, cc = skimage.draw.polygon(y_, x_, is_grid.shape)
-            is_grid[rr, cc] = True
+        # contiguous (n_cells, 4) vertices for the compiled rasterizer
+        x_px_c = np.ascontiguousarray(np.ma.filled(x_px_c), dtype='float32')
+        y_px_c = np.ascontiguousarray(np.ma.filled(y_px_c), dtype='float32')
+        rasterize_quads(x_px_c, y_px_c, is_grid)
         # want to dilate the grid a bit so colors will run through
         # is_grid = ~skimage.morphology.dilation(is_grid, skimage.morphology.square(5))
 
-        # compute interpolation function
-        X_web = grid['X_web']
-        Y_web = grid['Y_web']
-        mask = np.logical_or(X_web.mask, Y_web.mask)
-        XY_web = np.c_[X_web[~mask], Y_web[~mask]]
-        uv = np.c_[grid['u1_0'][~mask], grid['v1_0'][~mask]]
-        F = scipy.interpolate.LinearNDInterpolator(
-            XY_web,
-            uv
-        )
-        F.fill_value = 0.0
+        rows, cols, outside = self.canvas_indices(grid['X_web'], grid['Y_web'], X_web_canvas, Y_web_canvas)
+        mask = np.logical_or(grid['X_web'].mask, grid['Y_web'].mask)
         logger.debug("Canvas generated")
         return dict(
             X=X_web_canvas,
@@ -220,7 +205,9 @@ class Delft3DMatlab(NetCDF):
             bbox_web=ll_web + ur_web,
             is_grid=is_grid,
             mask=mask,
-            F=F
+            rows=rows,
+            cols=cols,
+            outside=outside
         )
 
     def timeseries(self, i, j):
@@ -245,12 +232,9 @@ class Delft3DMatlab(NetCDF):
     def extract_points(self, points, filename="points.json"):
         grid = self.grid
         features = []
-        for p in points:
+        for p, i, j, distance in zip(points, *nearest_points(grid["lat"], grid["lon"], points)):
             lat_i, lon_i = p
-            distance = np.sqrt((grid["lat"] - lat_i)**2 + (grid["lon"] - lon_i)**2)
-            i = np.argmin(distance)
-            i, j = np.unravel_index(i, distance.shape)
-            logger.info("distance %s", distance.min())
+            logger.info("distance %s", distance)
             logger.info("closest point for %s is %s, %s", p, i, j)
 
             point = geojson.Point(coordinates=[float(lon_i), float(lat_i)])
@@ -3,6 +3,7 @@ import logging
 import functools
 
 import numpy as np
+import scipy.spatial
 import matplotlib.colors
 import tqdm
 
@@ -27,7 +28,7 @@ def get_format(dataset, **kwargs):
 
 
 def transform(x, y, transformation):
-    """transform coordinates, for n-d coordinates with masks"""
+    """transform coordinates, for n-d coordinates with masks, using an osr transformation or pyproj transformer"""
     if len(x.shape) <= 2:
         # curvilinear
         mask = np.logical_or(x.mask, y.mask)
@@ -41,8 +42,11 @@ def transform(x, y, transformation):
     new_shape = np.prod(xy.shape[:-1]), +  xy.shape[-1],
     # make sure you don't use a masked array (very slooow)
     xy = xy.reshape(new_shape).filled()
-    xy_t = transformation.TransformPoints(xy)
-    x_t, y_t, _ = np.array(xy_t).T
+    if hasattr(transformation, 'TransformPoints'):
+        xy_t = transformation.TransformPoints(xy)
+        x_t, y_t, _ = np.array(xy_t).T
+    else:
+        x_t, y_t = transformation.transform(xy[:, 0], xy[:, 1])
     x_t = x_t.reshape(old_shape)
     y_t = y_t.reshape(old_shape)
     X_t = np.ma.masked_all_like(x)
@@ -52,6 +56,20 @@ def transform(x, y, transformation):
     return X_t, Y_t
 
 
+def nearest_points(lat, lon, points):
+    """lookup the indices (i, j) of the grid points closest to each (lat, lon) point, masked grid points are skipped"""
+    mask = np.logical_or(np.ma.getmaskarray(lat), np.ma.getmaskarray(lon))
+    idx = np.flatnonzero(~mask)
+    latlon = np.c_[
+        np.ma.getdata(lat).ravel()[idx],
+        np.ma.getdata(lon).ravel()[idx]
+    ]
+    tree = scipy.spatial.cKDTree(latlon)
+    distance, nearest = tree.query(np.asarray(points, dtype='float64'), k=1)
+    i, j = np.unravel_index(idx[nearest], lat.shape)
+    return i, j, distance
+
+
 @functools.lru_cache()
 def build_fill_rules():
     """define fill rules for a 5x5 matrix"""
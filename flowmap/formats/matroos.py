@@ -1,4 +1,5 @@
 import logging
+import os
 import itertools
 import json
 import functools
@@ -7,15 +8,13 @@ import pathlib
 import tqdm
 import pandas
 import netCDF4
+import numexpr as ne
 import numpy as np
-import matplotlib.colors
-import skimage.draw
-import scipy.interpolate
+import PIL.Image
 
-from .formats import transform, contours2vertices
+from .formats import transform, contours2vertices, nearest_points
 from .netcdf import NetCDF
-
-import matplotlib.pyplot as plt
+from .._rasterize import rasterize_quads
 
 
 logger = logging.getLogger(__name__)
@@ -31,11 +30,9 @@ class Matroos(NetCDF):
     def grid(self):
         """generate global variables"""
 
-        src2wgs84 = self.srs['src2wgs84']
-        wgs842utm = self.srs['wgs842utm']
-        src2utm = self.srs['src2utm']
-        src2web = self.srs['src2web']
-        utm2web = self.srs['utm2web']
+        wgs842utm = self.transformers['wgs842utm']
+        src2utm = self.transformers['src2utm']
+        src2web = self.transformers['src2web']
 
         with netCDF4.Dataset(self.path) as ds:
             time = netCDF4.num2date(
@@ -90,8 +87,8 @@ class Matroos(NetCDF):
     def canvas(self, bbox_wgs84=None):
         """determine the rendering canvas and compute coordinates"""
         logger.debug("Computing canvas properties")
-        web2wgs84 = self.srs['web2wgs84']
-        utm2web = self.srs['utm2web']
+        web2wgs84 = self.transformers['web2wgs84']
+        utm2web = self.transformers['utm2web']
 
         grid = self.grid
 
@@ -105,8 +102,9 @@ class Matroos(NetCDF):
         x_web_canvas = np.linspace(ll_web[0], ur_web[0], num=nx)
         y_web_canvas = np.linspace(ll_web[1], ur_web[1], num=ny)
 
-        ll_wgs84 = web2wgs84.TransformPoint(x_web_canvas[0], y_web_canvas[0])
-        ur_wgs84 = web2wgs84.TransformPoint(x_web_canvas[-1], y_web_canvas[-1])
+        # (lon, lat, z), same as osr TransformPoint
+        ll_wgs84 = web2wgs84.transform(x_web_canvas[0], y_web_canvas[0]) + (0.0, )
+        ur_wgs84 = web2wgs84.transform(x_web_canvas[-1], y_web_canvas[-1]) + (0.0, )
 
         # coordinates in map space
         X_web_canvas, Y_web_canvas = np.meshgrid(x_web_canvas, y_web_canvas)
@@ -122,23 +120,15 @@ class Matroos(NetCDF):
         y_px_c = ny * (y_web_c - ll_web[1]) / (ur_web[1] - ll_web[1])
 
         is_grid = np.zeros((ny, nx), dtype='bool')
-        for x_, y_ in tqdm.tqdm(zip(x_px_c.filled(), y_px_c.filled()), desc="drawing is_grid", total=x_px_c.shape[0]):
-            rr, cc = skimage.draw.polygon(y_, x_, is_grid.shape)
-            is_grid[rr, cc] = True
+        # contiguous (n_cells, 4) vertices for the compiled rasterizer
+        x_px_c = np.ascontiguousarray(x_px_c.filled(), dtype='float32')
+        y_px_c = np.ascontiguousarray(y_px_c.filled(), dtype='float32')
+        rasterize_quads(x_px_c, y_px_c, is_grid)
         # want to dilate the grid a bit so colors will run through
         # is_grid = ~skimage.morphology.dilation(is_grid, skimage.morphology.square(5))
 
-        # compute interpolation function
-        X_web = grid['X_web']
-        Y_web = grid['Y_web']
-        mask = np.logical_or(X_web.mask, Y_web.mask)
-        XY_web = np.c_[X_web[~mask], Y_web[~mask]]
-        uv = np.c_[grid['u1_0'][~mask], grid['v1_0'][~mask]]
-        F = scipy.interpolate.LinearNDInterpolator(
-            XY_web,
-            uv
-        )
-        F.fill_value = 0.0
+        rows, cols, outside = self.canvas_indices(grid['X_web'], grid['Y_web'], X_web_canvas, Y_web_canvas)
+        mask = np.logical_or(grid['X_web'].mask, grid['Y_web'].mask)
         logger.debug("Canvas generated")
         return dict(
             X=X_web_canvas,
@@ -149,91 +139,80 @@ class Matroos(NetCDF):
             bbox_web=ll_web + ur_web,
             is_grid=is_grid,
             mask=mask,
-            F=F
+            rows=rows,
+            cols=cols,
+            outside=outside
         )
 
     def animate(self):
         logger.debug("Generating animation")
-        F, X, Y = self.canvas['F'], self.canvas['X'], self.canvas['Y']
-
-        X_web = self.grid['X_web']
-        Y_web = self.grid['Y_web']
-        coordinate_mask = np.logical_or(X_web.mask, Y_web.mask)
-
         framescale = float(self.framescale)
         count = itertools.count()
 
-        N = matplotlib.colors.Normalize(self.vmin, self.vmax, clip=True)
-        for i in tqdm.tqdm(range(self.grid['time'].shape[0] - 1), desc="an-time"):
-            data_0 = self.variables(i)
-            data_1 = self.variables(i+1)
-            u0, v0 = data_0['u1'], data_0['v1']
-            u1, v1 = data_1['u1'], data_1['v1']
-
-            # points for which uv
-            uv0 = np.c_[u0[~coordinate_mask].filled(0), v0[~coordinate_mask].filled(0).ravel()]
-            F.values = uv0.astype(F.values.dtype)
-            UV0 = F(X, Y)
-
-            uv1 = np.c_[u1[~coordinate_mask].filled(0), v1[~coordinate_mask].filled(0).ravel()]
-            F.values = uv1.astype(F.values.dtype)
-            UV1 = F(X, Y)
-
-            # cells without a velocity (not used)
-            value_mask = np.logical_or(
-                np.logical_and(
-                    UV0[..., 0] == 0.0,
-                    UV0[..., 1] == 0.0
-                ),
-                np.logical_and(
-                    UV1[..., 0] == 0.0,
-                    UV1[..., 1] == 0.0
-                )
-            )
-            mask = np.logical_or.reduce([
-                ~self.canvas['is_grid']
-            ])
-            # value_mask
-
-            for j in tqdm.tqdm(range(int(framescale))):
-                UV = (1.0 - (j/framescale)) * UV0 + (j/framescale) * UV1
-                # set U and V to 0
-                UV[mask, 0] = 0.0
-                UV[mask, 1] = 0.0
-
-                # compute uv and mask with coordinate mask
-                RG = N(UV)
-                R, G = RG[..., 0], RG[..., 1]
-
-                B = np.zeros_like(R) + mask
-                RGB = np.dstack([R, G, B])
-                # store in filename
-                # TODO: generate with ffmpeg
-                path = pathlib.Path(self.path)
-                filename = path.parent / (path.stem + '_%06d.png' % (next(count), ))
-                plt.imsave(str(filename), RGB)
-
+        ne.set_num_threads(os.cpu_count())
+
+        # set U and V to 0 outside of the grid
+        mask = ~self.canvas['is_grid']
+        # frame buffer, blue channel is the mask
+        RGB = np.empty(mask.shape + (3, ))
+        RGB[..., 2] = mask
+        try:
+            data = self.variables(0)
+            UV1 = self.to_canvas(data['u1'], data['v1'])
+            # fix the color range on the first frame
+            vmin, scale = self.normalization(np.where(mask[..., np.newaxis], 0.0, UV1))
+            for i in tqdm.tqdm(range(self.grid['time'].shape[0] - 1), desc="an-time"):
+                # the last time step is the first of the next interval, only read the new one
+                UV0 = UV1
+                data = self.variables(i + 1)
+                UV1 = self.to_canvas(data['u1'], data['v1'])
+
+                for j in tqdm.tqdm(range(int(framescale))):
+                    # interpolate in time and mask in one pass
+                    UV = ne.evaluate(
+                        'where(mask, 0.0, (1.0 - a) * UV0 + a * UV1)',
+                        local_dict=dict(
+                            a=j / framescale,
+                            UV0=UV0,
+                            UV1=UV1,
+                            mask=mask[..., np.newaxis]
+                        )
+                    )
+                    # red and green are the normalized velocities
+                    self.normalize(UV, vmin, scale, out=RGB[..., :2])
+                    # store in filename
+                    # TODO: generate with ffmpeg
+                    path = pathlib.Path(self.path)
+                    filename = path.parent / (path.stem + '_%06d.png' % (next(count), ))
+                    # fast, low compression png, the frames are converted to a movie afterwards
+                    PIL.Image.fromarray((RGB * 255).astype('uint8')).save(str(filename), format='PNG', compress_level=1)
+        finally:
+            # the dataset is only needed while generating frames
+            self.close()
         return
 
     def extract_points(self, points, filename="timeseries.json"):
         grid = self.grid
+        i, j, distance = nearest_points(grid["lat"], grid["lon"], points)
+        for p, i_, j_, distance_ in zip(points, i, j, distance):
+            logger.info("closest point for %s is %s, %s (distance %s)", p, i_, j_, distance_)
+
+        # read the time series of all points in the open dataset
+        try:
+            frames = self.timeseries_points(i, j)
+        finally:
+            self.close()
+
         records = []
-        for p in points:
+        for p, i_, j_, ts in zip(points, i, j, frames):
             lat_i, lon_i = p
-            distance = np.sqrt((grid["lat"] - lat_i)**2 + (grid["lon"] - lon_i)**2)
-            i = np.argmin(distance)
-            i, j = np.unravel_index(i, distance.shape)
-            logger.info("distance %s", distance.shape)
-            logger.info("closest point for %s is %s, %s", p, i, j)
-            ts = self.timeseries(i, j)
-
             # convert forth and back to json
             data = json.loads(ts.to_json(orient="records"))
             record = {
                 "lat": float(lat_i),
                 "lon": float(lon_i),
-                "i": int(i),
-                "j": int(j),
+                "i": int(i_),
+                "j": int(j_),
                 "data": data
             }
             records.append(record)
@@ -241,12 +220,12 @@ class Matroos(NetCDF):
             json.dump(records, f, indent=2)
 
     def variables(self, t):
-        with netCDF4.Dataset(self.path) as ds:
-            # velocities of first row and column are not used
-            # TODO: this does not quite match up....
-            u1 = np.squeeze(ds.variables['velu'][t][self.s][1:, 1:])
-            v1 = np.squeeze(ds.variables['velv'][t][self.s][1:, 1:])
-            sep = np.squeeze(ds.variables['sep'][t][self.s][1:, 1:])
+        ds = self.ds
+        # velocities of first row and column are not used
+        # TODO: this does not quite match up....
+        u1 = np.squeeze(ds.variables['velu'][t][self.s][1:, 1:])
+        v1 = np.squeeze(ds.variables['velv'][t][self.s][1:, 1:])
+        sep = np.squeeze(ds.variables['sep'][t][self.s][1:, 1:])
         return dict(
             u1=u1,
             v1=v1,
@@ -254,23 +233,52 @@ class Matroos(NetCDF):
         )
 
     def timeseries(self, i, j):
-        with netCDF4.Dataset(self.path) as ds:
-            u1 = np.squeeze(ds.variables['velu'][:, i, j])
-            v1 = np.squeeze(ds.variables['velv'][:, i, j])
-            s1 = np.squeeze(ds.variables['sep'][:, i, j])
+        return self.timeseries_points([i], [j])[0]
+
+    def timeseries_points(self, i, j):
+        """time series for the points (i[k], j[k]), each point is read separately from the open dataset"""
+        ds = self.ds
+        self.check_chunking('velu')
 
         date = [str(x) for x in self.grid['time']]
 
-        df = pandas.DataFrame(
-            data=dict(
-                date=date,
-                t=self.grid['time'],
-                u1=u1,
-                v1=v1,
-                s1=s1
+        frames = []
+        # netCDF uses orthogonal indexing, so read one point at a time
+        for i_, j_ in zip(i, j):
+            df = pandas.DataFrame(
+                data=dict(
+                    date=date,
+                    t=self.grid['time'],
+                    u1=ds.variables['velu'][:, i_, j_],
+                    v1=ds.variables['velv'][:, i_, j_],
+                    s1=ds.variables['sep'][:, i_, j_]
+                )
             )
+            frames.append(df)
+        return frames
+
+    def check_chunking(self, name):
+        """warn once if variable name is chunked per time step, which makes reading time series slow"""
+        if name in self._warned:
+            return
+        self._warned.add(name)
+        var = self.ds.variables[name]
+        chunking = var.chunking()
+        if not isinstance(chunking, list) or chunking[0] != 1:
+            return
+        path = pathlib.Path(self.path)
+        specs = ['{}/{}'.format(var.dimensions[0], var.shape[0])]
+        specs += ['{}/1'.format(dim) for dim in var.dimensions[1:]]
+        command = 'nccopy -k 4 -c {} {} {}'.format(
+            ','.join(specs),
+            path.name,
+            path.with_name(path.stem + '_chunked.nc').name
+        )
+        msg = 'Variable {} is chunked per time step, reading time series is slow. Rechunk using the command: \n{}'.format(
+            var.name,
+            command
         )
-        return df
+        logger.warn(msg)
 
     def validate(self):
         """validate a file"""
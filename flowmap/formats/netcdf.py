@@ -1,11 +1,16 @@
 import logging
+import functools
 import hashlib
 import uuid
 import json
 import pathlib
 
 import netCDF4
+import numpy as np
 import osgeo.osr
+import pyproj
+import scipy.interpolate
+import scipy.ndimage
 import mako.template
 
 logger = logging.getLogger(__name__)
@@ -48,6 +53,22 @@ class NetCDF(object):
         # store extra options
         self.options = kwargs
         logger.debug("Object constructed with %s", vars(self))
+        self._ds = None
+        # names of variables that were already warned about
+        self._warned = set()
+
+    @property
+    def ds(self):
+        """the netCDF dataset, opened once and kept open for repeated reads"""
+        if self._ds is None:
+            self._ds = netCDF4.Dataset(self.path)
+        return self._ds
+
+    def close(self):
+        """close the netCDF dataset if it is open"""
+        if self._ds is not None:
+            self._ds.close()
+            self._ds = None
 
     @property
     def srs(self):
@@ -88,6 +109,80 @@ class NetCDF(object):
             src2web=src2web
         )
 
+    @property
+    @functools.lru_cache()
+    def transformers(self):
+        """pyproj transformers between the coordinate systems, same names as srs, always in x, y order"""
+        crs = dict(
+            src=self.src_epsg,
+            # google mercator
+            web=3857,
+            # Lat,Lon
+            wgs84=4326,
+            # local UTM
+            utm=self.dst_epsg
+        )
+        names = [
+            'src2wgs84', 'web2wgs84', 'utm2wgs84', 'wgs842utm',
+            'wgs842web', 'utm2web', 'src2utm', 'src2web'
+        ]
+        transformers = {}
+        for name in names:
+            src, dst = name.split('2')
+            transformers[name] = pyproj.Transformer.from_crs(crs[src], crs[dst], always_xy=True)
+        return transformers
+
+    @staticmethod
+    def canvas_indices(X_web, Y_web, X_canvas, Y_canvas):
+        """fractional (row, column) indices in the source grid of the canvas pixels and a mask of pixels outside the grid"""
+        # the source grid is structured, so we only need to invert the
+        # web mercator -> (row, column) mapping once
+        mask = np.logical_or(np.ma.getmaskarray(X_web), np.ma.getmaskarray(Y_web))
+        XY_web = np.c_[X_web[~mask], Y_web[~mask]]
+        rows, cols = np.indices(X_web.shape)
+        F = scipy.interpolate.LinearNDInterpolator(
+            XY_web,
+            np.c_[rows[~mask], cols[~mask]],
+            fill_value=np.nan
+        )
+        RC = F(X_canvas, Y_canvas)
+        # canvas pixels outside of the source grid
+        outside = np.isnan(RC[..., 0])
+        RC[outside] = 0
+        return RC[..., 0], RC[..., 1], outside
+
+    def to_canvas(self, u, v):
+        """interpolate velocities on the source grid to the canvas"""
+        coordinates = [self.canvas['rows'], self.canvas['cols']]
+        # nearest, so that pixels on the border of the grid are not mixed with the fill value
+        U = scipy.ndimage.map_coordinates(np.ma.filled(u, 0), coordinates, order=1, mode='nearest')
+        V = scipy.ndimage.map_coordinates(np.ma.filled(v, 0), coordinates, order=1, mode='nearest')
+        UV = np.dstack([U, V])
+        UV[self.canvas['outside']] = 0.0
+        return UV
+
+    def normalization(self, UV):
+        """offset and scale that map [vmin, vmax] to [0, 1]
+
+        Unset limits are taken from UV, pass the first frame to fix them for
+        the whole animation, as matplotlib.colors.Normalize does.
+        """
+        vmin = UV.min() if self.vmin is None else self.vmin
+        vmax = UV.max() if self.vmax is None else self.vmax
+        if vmin > vmax:
+            raise ValueError("minvalue must be less than or equal to maxvalue")
+        # all values map to 0 for an empty range
+        scale = 1.0 / (vmax - vmin) if vmax > vmin else 0.0
+        return vmin, scale
+
+    @staticmethod
+    def normalize(UV, vmin, scale, out):
+        """scale velocities to [0, 1] into out, as matplotlib.colors.Normalize(clip=True) without masked arrays"""
+        np.subtract(UV, vmin, out=out)
+        np.multiply(out, scale, out=out)
+        np.clip(out, 0.0, 1.0, out=out)
+        return out
+
     def dump(self):
         tmpl = mako.template.Template(dump_tmpl)
         with netCDF4.Dataset(self.path) as ds:
@@ -425,7 +425,7 @@ class UGrid(NetCDF):
                 topic=format
             )
             # save options to the netcdf file
-            subgrid.create_export(new_name, n_cells=len(tables), n_bins=20, attributes=kwargs)
+            subgrid.create_export(new_name, n_cells=tables['slice'].shape[0], n_bins=20, attributes=kwargs)
             subgrid.export_tables(new_name, tables)
         elif format == 'id_grid':
             dem = read_dem(self.options['dem'])
@@ -1,10 +1,7 @@
-import bisect
 import logging
 
+import numba
 import numpy as np
-import pandas as pd
-import tqdm
-import geojson
 import netCDF4
 import rasterio
 import osgeo.osr
@@ -46,175 +43,253 @@ def data_for_idx(face_idx, dem, grid, data):
     return data
 
 
-def compute_waterlevel_per_cell(row, dem):
-    """get the subgrid waterdepth image"""
-    # tables is a dataframe
-    bin_edges = row["bin_edges"]
-
-    # if we don't have any volume table
-    if bin_edges is None:
-        return None
-    volume_table = row["volume_table"]
-    cum_volume_table = row["cum_volume_table"]
-
-    # this part is once volume is known
-    vol_i = row['vol1']
-
-    fill_idx = bisect.bisect(cum_volume_table, vol_i)
-    if fill_idx > 0:
-        remaining_volume = vol_i - cum_volume_table[fill_idx - 1]
-    else:
-        remaining_volume = vol_i - cum_volume_table[0]
-    face_area = row['face_area']
-
-    # are we outside the volume table
-    if fill_idx >= len(cum_volume_table) - 1:
-        remaining = (vol_i - cum_volume_table[-1]) / face_area
-        target_level = bin_edges[-1] + remaining
-    else:
-        # we're in the volume table
-        remaining_volume_fraction = remaining_volume / volume_table[fill_idx]
-        target_level = bin_edges[fill_idx] + remaining_volume_fraction * (bin_edges[fill_idx + 1] - bin_edges[fill_idx])
-    result = float(target_level)
-    return result
-
-
-def build_tables(ugrid, dem, id_grid, valid_range=None):
+@numba.njit(parallel=True, cache=True, error_model='numpy')
+def subgrid_waterlevel(vol1, fill_idx, cum_volume_table, volume_table, bin_edges, face_area, valid, out):
+    """compute the subgrid waterlevel for all cells, results are stored in out"""
+    n_bins = cum_volume_table.shape[1]
+    for k in numba.prange(vol1.shape[0]):
+        # if we don't have any volume table
+        if not valid[k]:
+            out[k] = np.nan
+            continue
+        idx = fill_idx[k]
+        # are we outside the volume table
+        if idx >= n_bins - 1:
+            remaining = (vol1[k] - cum_volume_table[k, n_bins - 1]) / face_area[k]
+            out[k] = bin_edges[k, n_bins] + remaining
+        else:
+            # we're in the volume table
+            if idx > 0:
+                remaining_volume = vol1[k] - cum_volume_table[k, idx - 1]
+            else:
+                remaining_volume = vol1[k] - cum_volume_table[k, 0]
+            remaining_volume_fraction = remaining_volume / volume_table[k, idx]
+            out[k] = bin_edges[k, idx] + remaining_volume_fraction * (bin_edges[k, idx + 1] - bin_edges[k, idx])
+    return out
+
+
+@numba.njit(parallel=True, cache=True)
+def compute_tables(
+        dem_band, mask_ii, exclude_mask, id_grid, slices, order, pixel_area,
+        out_volume, out_cum, out_edges, out_nbin, out_area, out_valid
+):
+    """compute the topography histogram and volume tables for all faces, results are stored in the out arrays
+
+    mask_ii is the int32 integral image (padded with a leading row and column of zeros) of the dem mask,
+    faces are processed in the given order
+    """
+    ny, nx = dem_band.shape
+    n_bins = out_nbin.shape[1]
+    for n in numba.prange(order.shape[0]):
+        k = order[n]
+        out_valid[k] = False
+        j_min, j_max = max(slices[k, 0], 0), min(slices[k, 1], ny)
+        i_min, i_max = max(slices[k, 2], 0), min(slices[k, 3], nx)
+
+        # dem is missing, lookup the number of masked pixels from the integral image
+        if j_min < j_max and i_min < i_max:
+            n_masked = (
+                mask_ii[j_max, i_max] - mask_ii[j_min, i_max] -
+                mask_ii[j_max, i_min] + mask_ii[j_min, i_min]
+            )
+            # the int32 sums may have wrapped, the count per face fits in 32 bits so take it modulo 2 ** 32
+            if n_masked & 0xFFFFFFFF != 0:
+                continue
+
+        # first pass, find the range of our pixels
+        count = 0
+        lo = np.inf
+        hi = -np.inf
+        for j in range(j_min, j_max):
+            for i in range(i_min, i_max):
+                if exclude_mask[j, i] or id_grid[j, i] != k:
+                    continue
+                count += 1
+                lo = min(lo, dem_band[j, i])
+                hi = max(hi, dem_band[j, i])
+        # no pixels in our cell
+        if count == 0:
+            continue
+
+        # same bin edges as np.histogram, kept in double precision and only stored in single precision
+        if lo == hi:
+            lo -= 0.5
+            hi += 0.5
+        edges = np.empty(n_bins + 1)
+        for b in range(n_bins + 1):
+            edges[b] = lo + b * (hi - lo) / n_bins
+        edges[n_bins] = hi
+
+        # second pass, fill the histogram
+        out_nbin[k, :] = 0
+        norm = n_bins / (hi - lo)
+        for j in range(j_min, j_max):
+            for i in range(i_min, i_max):
+                if exclude_mask[j, i] or id_grid[j, i] != k:
+                    continue
+                value = dem_band[j, i]
+                b = min(int((value - lo) * norm), n_bins - 1)
+                # correct for rounding (last bin includes right edge)
+                if value < edges[b]:
+                    b -= 1
+                elif value >= edges[b + 1] and b != n_bins - 1:
+                    b += 1
+                out_nbin[k, max(b, 0)] += 1
+
+        n_cum = 0
+        cum_volume = 0.0
+        for b in range(n_bins):
+            n_cum += out_nbin[k, b]
+            volume = pixel_area * n_cum * (edges[b + 1] - edges[b])
+            cum_volume += volume
+            out_volume[k, b] = volume
+            out_cum[k, b] = cum_volume
+            out_edges[k, b] = edges[b]
+        out_edges[k, n_bins] = edges[n_bins]
+        out_area[k] = pixel_area * n_cum
+        out_valid[k] = True
+
+
+def build_tables(ugrid, dem, id_grid, valid_range=None, n_bins=20):
     """compute volume tables per cell"""
 
+    band = dem['band']
+    affine = dem['affine']
+    # pixels that are not used for the tables
+    exclude_mask = np.ma.getmaskarray(id_grid).copy()
     if (valid_range is not None) and (None not in valid_range):
         logger.info('filtering by valid-range %s', valid_range)
         invalid_mask = np.logical_or(
-            dem['band'] < valid_range[0],
-            dem['band'] > valid_range[1]
+            band < valid_range[0],
+            band > valid_range[1]
         )
-    else:
-        invalid_mask = np.zeros_like(dem['band'], dtype=bool)
+        exclude_mask |= np.ma.filled(invalid_mask, False)
 
-    # compute cache of histograms per cell
+    # pixel coordinates of all faces at once, masked coordinates are ignored
     faces = ugrid['face_coordinates']
-    rows = []
-    # TODO: run this in parallel (using concurrent futures)
-    for id_, face in tqdm.tqdm(enumerate(faces), total=faces.shape[0], desc='table rows'):
-        # # Use this for faster debugging of triangles
-        # if id_ < 4700:
-        #     continue
-        # if id_ > 4800:
-        #     break
-
-        affine = dem['affine']
-        # remove masked coordinates
-        face = face[~face.mask.any(axis=1), :]
-        face_px = dem['world2px'](face)
-        face_px2slice = np.s_[
-            face_px[:, 1].min():face_px[:, 1].max(),
-            face_px[:, 0].min():face_px[:, 0].max()
-        ]
-        face_slice = [
-            face_px2slice[0].start,
-            face_px2slice[0].stop,
-            face_px2slice[1].start,
-            face_px2slice[1].stop
-        ]
-        dem_i = dem['band'][face_px2slice]
-        ids_i_mask = id_grid[face_px2slice] != id_
-        # we have three conditions to exclude a cell
-        masks = [
-            # dem is missing
-            dem_i.mask,
-            # not our cell
-            ids_i_mask,
-        ]
-        # cell not set
-        if hasattr(ids_i_mask, 'mask') and ids_i_mask.mask.any():
-            masks.append(ids_i_mask.mask)
-        # invalid values
-        if valid_range is not None:
-            masks.append(
-                invalid_mask[face_px2slice]
-            )
-
-        mask = np.logical_or.reduce(masks)
-        if dem_i.mask.any() or mask.all():
-            n_per_bin, bin_edges = None, None
-            volume_table = None
-            cum_volume_table = None
-            face_area = None
-        else:
-            n_per_bin, bin_edges = np.histogram(dem_i[~mask], bins=20)
-            # should this be equal to non masked cells in dem_i?
-            n_cum = np.cumsum(n_per_bin)
-            volume_table = np.abs(affine.a * affine.e) * n_cum * np.diff(bin_edges)
-            face_area = np.abs(affine.a * affine.e) * n_cum
-            cum_volume_table = np.cumsum(volume_table)
-        extent = [
-            face[:, 0].min(),
-            face[:, 0].max(),
-            face[:, 1].min(),
-            face[:, 1].max()
-        ]
-        record = dict(
-            id=id_,
-            slice=face_slice,
-            face=face,
-            face_area=face_area,
-            volume_table=volume_table,
-            cum_volume_table=cum_volume_table,
-            n_per_bin=n_per_bin,
-            extent=extent,
-            bin_edges=bin_edges
-        )
-        rows.append(record)
+    face_mask = np.ma.getmaskarray(faces)
+    face_px = dem['world2px'](np.ma.filled(faces, 0).reshape(-1, 2)).reshape(faces.shape)
+    face_px = np.ma.masked_array(face_px, face_mask)
+    px_min = face_px.min(axis=1).filled(0)
+    px_max = face_px.max(axis=1).filled(0)
+    # row start, stop, column start, stop
+    slices = np.c_[px_min[:, 1], px_max[:, 1], px_min[:, 0], px_max[:, 0]].astype('int64')
+
+    n_faces = faces.shape[0]
+    # single precision is enough for the tables and halves the memory use
+    volume_table = np.zeros((n_faces, n_bins), dtype='float32')
+    cum_volume_table = np.zeros((n_faces, n_bins), dtype='float32')
+    bin_edges = np.zeros((n_faces, n_bins + 1), dtype='float32')
+    n_per_bin = np.zeros((n_faces, n_bins), dtype='int32')
+    face_area = np.zeros(n_faces)
+    valid = np.zeros(n_faces, dtype='bool')
+    # integral image of the dem mask, to count masked pixels per face in constant time
+    # built in place, the sums may wrap around for large dems, see compute_tables
+    mask_ii = np.zeros((band.shape[0] + 1, band.shape[1] + 1), dtype='int32')
+    np.cumsum(np.ma.getmaskarray(band), axis=0, dtype='int32', out=mask_ii[1:, 1:])
+    np.cumsum(mask_ii[1:, 1:], axis=1, out=mask_ii[1:, 1:])
+    # visit the faces in dem row order, so consecutive faces read nearby dem memory
+    order = np.argsort(slices[:, 0], kind='stable')
+    logger.info('computing tables for %s faces using %s threads', n_faces, numba.config.NUMBA_NUM_THREADS)
+    compute_tables(
+        np.ma.getdata(band),
+        mask_ii,
+        exclude_mask,
+        np.ma.getdata(id_grid),
+        slices,
+        order,
+        np.abs(affine.a * affine.e),
+        volume_table,
+        cum_volume_table,
+        bin_edges,
+        n_per_bin,
+        face_area,
+        valid
+    )
 
-    tables = pd.DataFrame.from_records(rows).set_index('id')
+    extent = np.ma.stack([
+        faces[..., 0].min(axis=1),
+        faces[..., 0].max(axis=1),
+        faces[..., 1].min(axis=1),
+        faces[..., 1].max(axis=1)
+    ], axis=-1)
+
+    # same format as import_tables, cells without a table are masked
+    tables = dict(
+        slice=slices,
+        extent=extent,
+        face_area=face_area,
+        volume_table=volume_table,
+        cum_volume_table=cum_volume_table,
+        n_per_bin=n_per_bin,
+        bin_edges=bin_edges
+    )
+    for var in ['face_area', 'volume_table', 'cum_volume_table', 'n_per_bin', 'bin_edges']:
+        tables[var] = np.ma.masked_array(tables[var])
+        tables[var][~valid] = np.ma.masked
     return tables
 
 
 def compute_waterlevels(grid, dem, tables, data):
     """compute subgrid waterdepth band"""
 
-    # register pandas progress
-    tqdm.tqdm(desc="computing features").pandas()
-
-    # list of face indices
-    face_ids = np.arange(tables['volume_table'].shape[0])
-
     tables['vol1'] = data['vol1']
     tables['s1'] = data['s1']
     tables['waterdepth'] = data['waterdepth']
 
-    results = []
-    # fill the in memory band
-    for face_id in tqdm.tqdm(face_ids, desc='subgrid compute'):
-        row = {}
-        for key, var in tables.items():
-            if key == 'metadata':
-                continue
-
-            row[key] = var[face_id]
-        result = compute_waterlevel_per_cell(row, dem=dem)
-        results.append(result)
+    # cells without a volume table are masked
+    valid = ~np.ma.getmaskarray(tables['bin_edges']).any(axis=1)
+    bin_edges = np.ma.filled(tables['bin_edges'], np.nan)
+    volume_table = np.ma.filled(tables['volume_table'], np.nan)
+    cum_volume_table = np.ma.filled(tables['cum_volume_table'], np.nan)
+    face_area = np.ma.filled(tables['face_area'], np.nan).astype('float64')
+    vol1 = np.ma.filled(tables['vol1'], np.nan).astype('float64')
+
+    # bisect for all cells at once (cumulative tables are sorted)
+    fill_idx = (cum_volume_table <= vol1[:, np.newaxis]).sum(axis=1)
+    results = np.empty_like(vol1)
+    subgrid_waterlevel(
+        vol1,
+        fill_idx,
+        cum_volume_table,
+        volume_table,
+        bin_edges,
+        face_area,
+        valid,
+        results
+    )
     tables['subgrid_waterlevel'] = results
 
-    features = []
-    centroids = grid['face_centroids']
-    for face_id in tqdm.tqdm(face_ids, desc='exporting features'):
-        """convert row 2 features"""
-        centroid = centroids[face_id]
-        feature = geojson.Feature(
-            geometry=geojson.Point(
-                coordinates=tuple(centroid)
-            ),
-            id=face_id,
-            properties={
-                "s1": data['s1'][face_id],
-                "subgrid_waterlevel": tables['subgrid_waterlevel'][face_id],
-                "vol1": tables['vol1'][face_id],
-                "waterdepth": tables['waterdepth'][face_id]
+    # convert all columns to python lists at once and build plain geojson dicts
+    columns = zip(
+        range(len(results)),
+        np.ma.filled(grid['face_centroids'], np.nan).tolist(),
+        np.ma.filled(data['s1'], np.nan).tolist(),
+        results.tolist(),
+        vol1.tolist(),
+        np.ma.filled(data['waterdepth'], np.nan).tolist()
+    )
+    features = [
+        {
+            "type": "Feature",
+            "id": face_id,
+            "geometry": {
+                "type": "Point",
+                "coordinates": centroid
+            },
+            "properties": {
+                "s1": s1,
+                "subgrid_waterlevel": subgrid_waterlevel,
+                "vol1": vol1_i,
+                "waterdepth": waterdepth
             }
-        )
-        features.append(feature)
-    collection = geojson.FeatureCollection(features=features)
+        }
+        for face_id, centroid, s1, subgrid_waterlevel, vol1_i, waterdepth in columns
+    ]
+    collection = {
+        "type": "FeatureCollection",
+        "features": features
+    }
     return collection
 
 
@@ -264,19 +339,19 @@ def create_export(filename, n_cells, n_bins, attributes=None):
             "name": "bin_edges",
             "dimensions": ("cells", "bin_edges"),
             "long_name": "bin edges of topography histogram",
-            "type": "double"
+            "type": "float32"
         },
         {
             "name": "cum_volume_table",
             "dimensions": ("cells", "bins"),
             "long_name": "cumulative volume table",
-            "type": "double"
+            "type": "float32"
         },
         {
             "name": "volume_table",
             "dimensions": ("cells", "bins"),
             "long_name": "volume table",
-            "type": "double"
+            "type": "float32"
         },
         {
             "name": "face_area",
@@ -294,7 +369,7 @@ def create_export(filename, n_cells, n_bins, attributes=None):
             "name": "n_per_bin",
             "dimensions": ("cells", "bins"),
             "long_name": "topography histogram",
-            "type": "int"
+            "type": "int32"
         },
         {
             "name": "slice",
@@ -326,21 +401,12 @@ def create_export(filename, n_cells, n_bins, attributes=None):
 def export_tables(filename, tables):
     """store tables in netcdf file, create file with create_export"""
     with netCDF4.Dataset(filename, 'r+') as ds:
-        for (i, row) in tqdm.tqdm(
-            tables.reset_index().iterrows(),
-            total=len(tables),
-            desc='exporting'
-        ):
-            for var in [
-                'bin_edges', 'cum_volume_table', 'volume_table',
-                'extent', 'n_per_bin', 'face_area', 'slice'
-            ]:
-                val = row[var]
-                # skip none
-                if val is None:
-                    continue
-
-                ds.variables[var][i] = val
+        for var in [
+            'bin_edges', 'cum_volume_table', 'volume_table',
+            'extent', 'n_per_bin', 'face_area', 'slice'
+        ]:
+            # write all cells at once, cells without a table are masked and stored as fill value
+            ds.variables[var][:] = tables[var]
 
 
 def import_tables(filename):
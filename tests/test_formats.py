@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+
+import sys
+import unittest
+import logging
+
+import numpy as np
+
+from flowmap.formats import formats
+from flowmap.formats.netcdf import NetCDF
+
+logger = logging.getLogger(__name__)
+
+
+class TestFormats(unittest.TestCase):
+
+    def setUp(self):
+        # regular 3 x 4 grid with one masked point
+        lon, lat = np.meshgrid(np.arange(4.0), np.arange(3.0))
+        self.lat = np.ma.masked_array(lat)
+        self.lon = np.ma.masked_array(lon)
+        self.lat[1, 1] = np.ma.masked
+
+    def tearDown(self):
+        pass
+
+    def test_nearest_points(self):
+        points = [
+            (0.1, 0.2),
+            (2.0, 3.0),
+            (1.9, 2.6),
+            # closest to the masked point (1, 1)
+            (1.0, 1.2)
+        ]
+        i, j, distance = formats.nearest_points(self.lat, self.lon, points)
+        np.testing.assert_array_equal(i, [0, 2, 2, 1])
+        np.testing.assert_array_equal(j, [0, 3, 3, 2])
+        np.testing.assert_allclose(distance, [np.hypot(0.1, 0.2), 0.0, np.hypot(0.1, 0.4), 0.8])
+
+    def test_normalization_first_frame(self):
+        # without vmin and vmax the range is fixed by the first frame
+        nc = NetCDF('dummy.nc', vmin=None, vmax=None)
+        vmin, scale = nc.normalization(np.array([0.0, 1.0]))
+        out = np.empty(2)
+        np.testing.assert_allclose(nc.normalize(np.array([0.0, 2.0]), vmin, scale, out=out), [0.0, 1.0])
+        np.testing.assert_allclose(nc.normalize(np.array([-1.0, 0.5]), vmin, scale, out=out), [0.0, 0.5])
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+
+import sys
+import unittest
+
+import numpy as np
+
+from flowmap._rasterize import rasterize_quads
+
+
+class TestRasterize(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_rasterize_square(self):
+        xs = np.array([[1, 3, 3, 1]], dtype='float32')
+        ys = np.array([[1, 1, 3, 3]], dtype='float32')
+        is_grid = np.zeros((5, 5), dtype='bool')
+        rasterize_quads(xs, ys, is_grid)
+        expected = np.zeros((5, 5), dtype='bool')
+        expected[1:3, 1:4] = True
+        np.testing.assert_array_equal(is_grid, expected)
+
+    def test_rasterize_outside(self):
+        xs = np.array([[-3, -1, -1, -3]], dtype='float32')
+        ys = np.array([[1, 1, 3, 3]], dtype='float32')
+        is_grid = np.zeros((5, 5), dtype='bool')
+        rasterize_quads(xs, ys, is_grid)
+        assert not is_grid.any()
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
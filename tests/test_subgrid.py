@@ -2,6 +2,8 @@
 
 
 import unittest
+import tempfile
+import pathlib
 import logging
 
 import numpy as np
@@ -61,6 +63,16 @@ class TestSubgrid(unittest.TestCase):
         )
         self.dem['world2px'] = lambda xy: np.vstack((~self.dem['affine']) * (xy[:, 0], xy[:, 1])).T.astype('int')
 
+        # dem covering the whole grid
+        self.dem_full = dict(
+            band=np.ma.masked_array(np.arange(64, dtype='float32').reshape((8, 8))),
+            affine=rasterio.transform.Affine(
+                0.25, 0.0, 0,
+                0.0, -0.25, 2
+            )
+        )
+        self.dem_full['world2px'] = lambda xy: np.vstack((~self.dem_full['affine']) * (xy[:, 0], xy[:, 1])).T.astype('int')
+
     def tearDown(self):
         pass
 
@@ -75,6 +87,86 @@ class TestSubgrid(unittest.TestCase):
         tables = subgrid.build_tables(self.grid.ugrid, self.dem, id_grid)
         assert len(tables) > 0
 
+    def test_build_tables_histogram(self):
+        dem = self.dem_full
+        polys = self.grid.to_polys()
+        id_grid = subgrid.build_id_grid(polys, dem)
+        tables = subgrid.build_tables(self.grid.ugrid, dem, id_grid)
+        n_per_bin = tables['n_per_bin'][0]
+        assert n_per_bin.sum() == (id_grid == 0).sum()
+        assert np.all(np.diff(tables['cum_volume_table'][0]) >= 0)
+        np.testing.assert_allclose(tables['face_area'][0], 0.0625 * n_per_bin.sum())
+
+    def test_build_tables_float64(self):
+        # regular 6 x 8 grid of faces on a random double precision dem
+        x, y = np.meshgrid(np.linspace(0, 8, num=9), np.linspace(0, 6, num=7))
+        nodes = np.c_[x.ravel(), y.ravel()]
+        i, j = np.meshgrid(np.arange(8), np.arange(6))
+        ll = (j * 9 + i).ravel()
+        faces = np.ma.masked_array(np.c_[ll, ll + 1, ll + 10, ll + 9], mask=False)
+        face_coordinates = np.ma.masked_array(nodes[faces], mask=False)
+        ugrid = dict(faces=faces, face_coordinates=face_coordinates)
+        grid = type(self.grid)()
+        grid.ugrid = ugrid
+
+        dem = dict(
+            band=np.ma.masked_array(np.random.RandomState(0).uniform(-3, 7, size=(60, 80))),
+            affine=rasterio.transform.Affine(
+                0.1, 0.0, 0,
+                0.0, -0.1, 6
+            )
+        )
+        dem['world2px'] = lambda xy: np.vstack((~dem['affine']) * (xy[:, 0], xy[:, 1])).T.astype('int')
+        id_grid = subgrid.build_id_grid(grid.to_polys(), dem)
+        tables = subgrid.build_tables(ugrid, dem, id_grid)
+        valid = ~np.ma.getmaskarray(tables['n_per_bin']).any(axis=1)
+        assert valid.sum() > 0
+        for k in np.flatnonzero(valid):
+            j_min, j_max, i_min, i_max = tables['slice'][k]
+            s = np.s_[j_min:j_max, i_min:i_max]
+            values = dem['band'][s][id_grid[s] == k]
+            n_per_bin, bin_edges = np.histogram(values, bins=20)
+            np.testing.assert_array_equal(tables['n_per_bin'][k], n_per_bin)
+            np.testing.assert_allclose(tables['bin_edges'][k], bin_edges, rtol=1e-6)
+
+    def test_export_import_tables(self):
+        polys = self.grid.to_polys()
+        id_grid = subgrid.build_id_grid(polys, self.dem_full)
+        tables = subgrid.build_tables(self.grid.ugrid, self.dem_full, id_grid)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = pathlib.Path(tmpdir) / 'tables.nc'
+            subgrid.create_export(filename, n_cells=tables['slice'].shape[0], n_bins=tables['n_per_bin'].shape[1])
+            subgrid.export_tables(filename, tables)
+            imported = subgrid.import_tables(filename)
+        for var in ['bin_edges', 'cum_volume_table', 'volume_table', 'extent', 'n_per_bin', 'slice', 'face_area']:
+            np.testing.assert_array_equal(np.ma.getmaskarray(imported[var]), np.ma.getmaskarray(tables[var]))
+            np.testing.assert_allclose(imported[var].compressed(), np.ma.masked_array(tables[var]).compressed())
+
+    def test_compute_waterlevels(self):
+        # same volume table for all cells, last cell has no table
+        n_cells = 4
+        tables = dict(
+            bin_edges=np.ma.masked_array(np.tile([0.0, 1.0, 2.0, 3.0], (n_cells, 1))),
+            volume_table=np.ma.masked_array(np.tile([1.0, 2.0, 3.0], (n_cells, 1))),
+            cum_volume_table=np.ma.masked_array(np.tile([1.0, 3.0, 6.0], (n_cells, 1))),
+            face_area=np.ma.masked_array(np.full(n_cells, 3.0))
+        )
+        for var in ['bin_edges', 'volume_table', 'cum_volume_table', 'face_area']:
+            tables[var][-1] = np.ma.masked
+        data = dict(
+            vol1=np.array([0.5, 2.0, 9.0, 1.0]),
+            s1=np.zeros(n_cells),
+            waterdepth=np.zeros(n_cells)
+        )
+        grid = dict(face_centroids=np.zeros((n_cells, 2)))
+        collection = subgrid.compute_waterlevels(grid, self.dem, tables, data)
+        levels = [feature['properties']['subgrid_waterlevel'] for feature in collection['features']]
+        # below the first bin (idx == 0): 0 + (0.5 - 1) / 1
+        # in the table: 1 + (2 - 1) / 2
+        # above the table: 3 + (9 - 6) / 3
+        # no table: nan
+        np.testing.assert_allclose(levels, [-0.5, 1.5, 4.0, np.nan])
+
     def test_subgrid(self):
         polys = self.grid.to_polys()
         id_grid = subgrid.build_id_grid(polys, self.dem)